@@ -1,20 +1,34 @@
 import os
+import re
 import time
+import calendar
+import importlib.util
 import asyncio
 import logging
-from typing import Dict, Any, List, Tuple, Optional
+from typing import Dict, Any, List, Tuple, Optional, Deque
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 import html as _html
+from collections import OrderedDict, deque, Counter
+from functools import lru_cache
+from pathlib import Path
+from bisect import bisect_right
 
 import aiosqlite
 import httpx
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+HTTP2 = importlib.util.find_spec("h2") is not None
+
 from aiogram import Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.filters import Command
-from aiogram.exceptions import TelegramNetworkError
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter
 from aiogram.types import (
     Message,
     ReplyKeyboardMarkup,
@@ -58,7 +72,16 @@ class KalshiHTTP:
     def __init__(self):
         self.hosts = [PRIMARY] if os.getenv("KALSHI_BASE_URL") else [PRIMARY, FALLBACK]
         self.host: Optional[str] = None
-        self.client = httpx.AsyncClient(timeout=10.0, headers={"User-Agent": "Valshi/1.6"})
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(10.0, connect=3.0),
+            transport=httpx.AsyncHTTPTransport(
+                http2=HTTP2,
+                retries=0,
+                limits=httpx.Limits(max_keepalive_connections=20, max_connections=40, keepalive_expiry=30),
+            ),
+            follow_redirects=False,
+            headers={"User-Agent": "Valshi/1.6"},
+        )
         self.min_ts_supported: Optional[bool] = None
 
     async def pick_host(self):
@@ -91,7 +114,7 @@ class KalshiHTTP:
                 if h != self.host:
                     self.host = h
                     log.info("Pinned Kalshi host to %s after failover", h)
-                return r.json()
+                return orjson.loads(r.content) if orjson is not None else r.json()
             except (httpx.ConnectError, httpx.ReadTimeout, httpx.NetworkError) as e:
                 last_err = e
                 log.warning("GET %s failed (%s). Trying next host…", url, e.__class__.__name__)
@@ -108,8 +131,6 @@ class KalshiHTTP:
 KALSHI = KalshiHTTP()
 
 SCHEMA_SQL = """
-PRAGMA journal_mode=WAL;
-
 CREATE TABLE IF NOT EXISTS subs (
   user_id     INTEGER PRIMARY KEY,
   alerts_on   INTEGER NOT NULL DEFAULT 0,
@@ -130,8 +151,9 @@ CREATE TABLE IF NOT EXISTS prints (
   flags        TEXT    NOT NULL DEFAULT ''
 );
 
-CREATE INDEX IF NOT EXISTS idx_prints_ts ON prints(ts_ms);
+DROP INDEX IF EXISTS idx_prints_ts;
 CREATE INDEX IF NOT EXISTS idx_prints_ticker_ts ON prints(ticker, ts_ms);
+CREATE INDEX IF NOT EXISTS idx_prints_notional ON prints(ts_ms, notional_usd DESC, ticker, side);
 
 CREATE TABLE IF NOT EXISTS stats (
   ticker           TEXT PRIMARY KEY,
@@ -144,15 +166,58 @@ CREATE TABLE IF NOT EXISTS meta (
 );
 """
 
+PRINTS_RETENTION_MS = 7*24*3600*1000
+PRUNE_INTERVAL = 3600
+
+DB: Optional[aiosqlite.Connection] = None
+RDB: Optional[aiosqlite.Connection] = None
+DB_LOCK = asyncio.Lock()
+
+async def _prep(db: aiosqlite.Connection, readonly: bool = False):
+    if readonly:
+        await db.execute("PRAGMA query_only=1")
+    else:
+        await db.execute("PRAGMA journal_mode=WAL")
+        await db.execute("PRAGMA synchronous=NORMAL")
+    await db.execute("PRAGMA busy_timeout=5000")
+    await db.execute("PRAGMA temp_store=MEMORY")
+    await db.execute("PRAGMA mmap_size=134217728")
+    await db.execute("PRAGMA cache_size=-20000")
+
 async def db_init():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.executescript(SCHEMA_SQL)
-        try:
-            await db.execute("ALTER TABLE subs ADD COLUMN tz TEXT NOT NULL DEFAULT 'UTC'")
-            await db.commit()
-        except Exception:
-            pass
+    global DB, RDB
+    if DB is not None:
+        return
+    db = await aiosqlite.connect(DB_PATH)
+    await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    await _prep(db)
+    await db.executescript(SCHEMA_SQL)
+    cur = await db.execute("PRAGMA auto_vacuum")
+    row = await cur.fetchone()
+    await cur.close()
+    if row and int(row[0]) != 2:
+        log.info("Rebuilding DB once to enable incremental auto_vacuum…")
+        await db.execute("DELETE FROM prints WHERE ts_ms < ?", (now_ms() - PRINTS_RETENTION_MS,))
+        await db.commit()
+        await db.execute("VACUUM")
+    try:
+        await db.execute("ALTER TABLE subs ADD COLUMN tz TEXT NOT NULL DEFAULT 'UTC'")
         await db.commit()
+    except Exception:
+        pass
+    await db.commit()
+    rdb = await aiosqlite.connect(Path(DB_PATH).resolve().as_uri() + "?mode=ro", uri=True)
+    await _prep(rdb, readonly=True)
+    DB, RDB = db, rdb
+
+async def db_close():
+    global DB, RDB
+    if RDB is not None:
+        await RDB.close()
+        RDB = None
+    if DB is not None:
+        await DB.close()
+        DB = None
 
 async def db_get(db, key: str, default: str = "") -> str:
     cur = await db.execute("SELECT value FROM meta WHERE key=?", (key,))
@@ -166,11 +231,13 @@ async def db_set(db, key: str, value: str):
         "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
         (key, value)
     )
-    await db.commit()
 
 def now_ms() -> int:
     return int(time.time() * 1000)
 
+_MDAYS = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+_ISO_UTC_RE = re.compile(r"^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?(?:Z|[+-]00:?00)$")
+
 def parse_ts_to_ms(ts: Any) -> int:
     if ts is None:
         return now_ms()
@@ -178,6 +245,13 @@ def parse_ts_to_ms(ts: Any) -> int:
     if s.isdigit():
         v = int(s)
         return v if v > 10_000_000_000 else v * 1000
+    mo = _ISO_UTC_RE.match(s)
+    if mo:
+        y, mon, d, h, mi, sec = (int(g) for g in mo.groups()[:6])
+        frac = mo.group(7)
+        if 1 <= mon <= 12 and 1 <= d <= _MDAYS[mon-1] + (mon == 2 and calendar.isleap(y)) and h < 24 and mi < 60 and sec < 60:
+            ms = calendar.timegm((y, mon, d, h, mi, sec, 0, 0, 0)) * 1000
+            return ms + (int(frac.ljust(6, "0")) // 1000 if frac else 0)
     try:
         return int(datetime.fromisoformat(s.replace("Z","+00:00")).timestamp() * 1000)
     except Exception:
@@ -186,49 +260,141 @@ def parse_ts_to_ms(ts: Any) -> int:
 def pct_str(p: float) -> str:
     return f"{int(round(p*100))}%"
 
+_CRYPTO_KEYS = ("BTC", "CRYPTO")
+_MACRO_KEYS  = ("CPI", "FED", "RATE", "UNEMP", "GDP", "PCE")
+_SPORTS_KEYS = ("NFL", "NBA", "MLB", "NHL", "EPL")
+
+@lru_cache(maxsize=8192)
 def categorize_ticker(tk: str) -> str:
     t = (tk or "").upper()
-    if "BTC" in t or "CRYPTO" in t: return "crypto"
-    if any(k in t for k in ("CPI","FED","RATE","UNEMP","GDP","PCE")): return "macro"
-    if any(k in t for k in ("NFL","NBA","MLB","NHL","EPL")): return "sports"
+    if any(k in t for k in _CRYPTO_KEYS): return "crypto"
+    if any(k in t for k in _MACRO_KEYS): return "macro"
+    if any(k in t for k in _SPORTS_KEYS): return "sports"
     return "other"
 
-def topic_match(user_topic: str, tk: str) -> bool:
-    return user_topic == "all" or categorize_ticker(tk) == user_topic
+SubGroups = Dict[str, Tuple[List[float], List[Tuple[int, str]]]]
+
+def group_subs_by_topic(active_subs: List[Tuple[int, float, str, str]]) -> SubGroups:
+    groups: SubGroups = {}
+    for uid, thr, top, tz in sorted(active_subs, key=lambda s: s[1]):
+        thrs, members = groups.setdefault(top, ([], []))
+        thrs.append(thr)
+        members.append((uid, tz))
+    return groups
+
+def alert_targets(groups: SubGroups, ticker: str, notional: float) -> List[Tuple[int, str]]:
+    out: List[Tuple[int, str]] = []
+    for top in ("all", categorize_ticker(ticker)):
+        g = groups.get(top)
+        if g:
+            thrs, members = g
+            out.extend(members[:bisect_right(thrs, notional)])
+    return out
+
+_TZ_CACHE: Dict[str, Any] = {}
+
+def _tz(tz_str: str):
+    tz = _TZ_CACHE.get(tz_str)
+    if tz is None:
+        try:
+            tz = ZoneInfo(tz_str)
+        except Exception:
+            tz = timezone.utc
+        _TZ_CACHE[tz_str] = tz
+    return tz
 
-def median(lst: List[float]) -> float:
-    if not lst: return 0.0
-    a = sorted(lst); n = len(a); mid = n // 2
-    return float(a[mid]) if n % 2 else (a[mid-1] + a[mid]) / 2.0
+_MONS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+_TZ_HOUR_CACHE: Dict[Tuple[str, int], Optional[Tuple[int, str]]] = {}
 
-def local_time_str(ts_ms: int, tz_str: str) -> str:
+def _tz_hour_info(tz_str: str, hour: int) -> Optional[Tuple[int, str]]:
+    key = (tz_str, hour)
     try:
-        dt = datetime.fromtimestamp(ts_ms/1000, tz=ZoneInfo(tz_str))
-        return dt.strftime("%b %d %H:%M %Z")
-    except Exception:
-        return datetime.fromtimestamp(ts_ms/1000, tz=timezone.utc).strftime("%b %d %H:%M UTC")
+        return _TZ_HOUR_CACHE[key]
+    except KeyError:
+        pass
+    tz = _tz(tz_str)
+    start = datetime.fromtimestamp(hour * 3600, tz=tz)
+    end = datetime.fromtimestamp(hour * 3600 + 3599, tz=tz)
+    info = None
+    if start.utcoffset() == end.utcoffset() and start.tzname() == end.tzname():
+        info = (int(start.utcoffset().total_seconds()), start.tzname())
+    if len(_TZ_HOUR_CACHE) >= 4096:
+        _TZ_HOUR_CACHE.clear()
+    _TZ_HOUR_CACHE[key] = info
+    return info
+
+def _month_day(days: int) -> Tuple[int, int]:
+    z = days + 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    return (mp + 3 if mp < 10 else mp - 9), doy - (153 * mp + 2) // 5 + 1
+
+def local_time_str(ts_ms: int, tz_str: str) -> str:
+    secs = ts_ms // 1000
+    info = _tz_hour_info(tz_str, secs // 3600)
+    if info is None:
+        return datetime.fromtimestamp(ts_ms/1000, tz=_tz(tz_str)).strftime("%b %d %H:%M %Z")
+    offset, tzname = info
+    days, rem = divmod(secs + offset, 86400)
+    mon, day = _month_day(days)
+    return f"{_MONS[mon-1]} {day:02d} {rem // 3600:02d}:{rem % 3600 // 60:02d} {tzname}"
 
 def kalshi_market_url_from_ticker(ticker: str) -> str:
     return f"https://kalshi.com/?search={ticker.upper()}"
 
-_titles_cache: Dict[str, str] = {}
+TITLE_CACHE_MAX = 2048
+TITLE_CACHE_TTL = 3600.0
+
+_titles_cache: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+_TITLE_INFLIGHT: Dict[str, "asyncio.Future[Optional[str]]"] = {}
+
+def _title_cached(tk: str) -> Optional[str]:
+    hit = _titles_cache.get(tk)
+    if hit is None:
+        return None
+    expires, title = hit
+    if expires < time.monotonic():
+        del _titles_cache[tk]
+        return None
+    _titles_cache.move_to_end(tk)
+    return title
+
+def _title_store(tk: str, title: str):
+    _titles_cache[tk] = (time.monotonic() + TITLE_CACHE_TTL, title)
+    _titles_cache.move_to_end(tk)
+    while len(_titles_cache) > TITLE_CACHE_MAX:
+        _titles_cache.popitem(last=False)
 
 async def get_market_title(ticker: str) -> Optional[str]:
     tk = (ticker or "").upper()
     if not tk:
         return None
-    if tk in _titles_cache:
-        return _titles_cache[tk]
+    title = _title_cached(tk)
+    if title is not None:
+        return title
+    fut = _TITLE_INFLIGHT.get(tk)
+    if fut is not None:
+        return await asyncio.shield(fut)
+    fut = asyncio.get_running_loop().create_future()
+    _TITLE_INFLIGHT[tk] = fut
+    title = None
     try:
         data = await KALSHI.get(f"/markets/{tk}")
         obj = data.get("market") or data.get("data") or data
-        title = (obj or {}).get("title") or (obj or {}).get("name")
-        if title:
-            _titles_cache[tk] = str(title)
-            return _titles_cache[tk]
+        raw = (obj or {}).get("title") or (obj or {}).get("name")
+        if raw:
+            title = str(raw)
+            _title_store(tk, title)
     except Exception as e:
         log.debug("Title lookup failed for %s: %s", tk, e)
-    return None
+    finally:
+        _TITLE_INFLIGHT.pop(tk, None)
+        if not fut.done():
+            fut.set_result(title)
+    return title
 
 async def ensure_sub(db, user_id: int):
     await db.execute(
@@ -236,15 +402,15 @@ async def ensure_sub(db, user_id: int):
         "ON CONFLICT(user_id) DO NOTHING",
         (user_id, 0, DEFAULT_THRESH, 'all', 'UTC')
     )
-    await db.commit()
 
 async def get_user_prefs(user_id: int) -> Tuple[int, float, str, str]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await ensure_sub(db, user_id)
-        cur = await db.execute("SELECT alerts_on, thresh_usd, topic, tz FROM subs WHERE user_id=?", (user_id,))
-        row = await cur.fetchone()
-        await cur.close()
+    cur = await RDB.execute("SELECT alerts_on, thresh_usd, topic, tz FROM subs WHERE user_id=?", (user_id,))
+    row = await cur.fetchone()
+    await cur.close()
     if not row:
+        async with DB_LOCK:
+            await ensure_sub(DB, user_id)
+            await DB.commit()
         return 0, DEFAULT_THRESH, "all", "UTC"
     return int(row[0]), float(row[1]), str(row[2]), str(row[3])
 
@@ -279,20 +445,19 @@ async def fetch_trades_since(min_ts_ms: int, limit: int = 1000) -> List[Dict[str
             return data.get("trades") or data.get("data") or data.get("results") or []
         raise
 
+def _as_float(v: Any) -> Optional[float]:
+    if type(v) is float or type(v) is int:
+        return float(v)
+    if v is None:
+        return None
+    try: return float(v)
+    except (TypeError, ValueError): return None
+
 def trade_notional_usd(tr: Dict[str, Any]) -> float:
     count = int(tr.get("count") or tr.get("size") or 0)
-    dollars = None
-    if "yes_price_dollars" in tr:
-        try: dollars = float(tr["yes_price_dollars"])
-        except Exception: dollars = None
-    cents = None
-    if "yes_price" in tr:
-        try: cents = float(tr["yes_price"])
-        except Exception: cents = None
-    elif "price" in tr:
-        try: cents = float(tr["price"])
-        except Exception: cents = None
+    dollars = _as_float(tr.get("yes_price_dollars"))
     if dollars is not None: return count * dollars
+    cents = _as_float(tr["yes_price"]) if "yes_price" in tr else _as_float(tr.get("price"))
     if cents is not None: return count * (cents / 100.0)
     return 0.0
 
@@ -305,36 +470,103 @@ def trade_core_fields(tr: Dict[str, Any]) -> Tuple[str, int, str, str, int, int]
     yes_cents = int(float(tr.get("yes_price") or tr.get("price") or 0))
     return trade_id, ts_ms, ticker, side, count, yes_cents
 
-async def ticker_recent_counts_24h(db, ticker: str) -> List[int]:
-    since = now_ms() - 24*3600*1000
-    cur = await db.execute("SELECT count FROM prints WHERE ticker=? AND ts_ms>=? ORDER BY ts_ms DESC LIMIT 5000", (ticker, since))
-    rows = await cur.fetchall()
+def parse_trades(trades: List[Dict[str, Any]]) -> List[Tuple[str, int, str, str, int, int, float]]:
+    out = []
+    for tr in trades:
+        notional = trade_notional_usd(tr)
+        if notional <= 0:
+            continue
+        out.append(trade_core_fields(tr) + (notional,))
+    out.sort(key=lambda r: r[1])
+    return out
+
+MEDIAN_CACHE_MS = 60_000
+
+MEDIAN_COUNT_24H_SQL = (
+    "WITH w AS (SELECT count FROM prints WHERE ticker=? AND ts_ms>=?), "
+    "n AS (SELECT COUNT(*) AS c FROM w) "
+    "SELECT AVG(count) FROM (SELECT count FROM w ORDER BY count "
+    "LIMIT 2 - (SELECT c FROM n) % 2 OFFSET ((SELECT c FROM n) - 1) / 2)"
+)
+
+_median_cache: Dict[str, Tuple[int, float]] = {}
+
+async def ticker_median_count_24h(db, ticker: str) -> float:
+    nowm = now_ms()
+    hit = _median_cache.get(ticker)
+    if hit and hit[0] > nowm:
+        return hit[1]
+    since = nowm - 24*3600*1000
+    cur = await db.execute(MEDIAN_COUNT_24H_SQL, (ticker, since))
+    row = await cur.fetchone()
     await cur.close()
-    return [int(r[0]) for r in rows]
+    med = float(row[0]) if row and row[0] is not None else 0.0
+    if len(_median_cache) >= 4096:
+        _median_cache.clear()
+    _median_cache[ticker] = (nowm + MEDIAN_CACHE_MS, med)
+    return med
+
+INSERT_PRINT_SQL = (
+    "INSERT OR IGNORE INTO prints(trade_id, ts_ms, ticker, side, count, yes_cents, notional_usd, flags) "
+    "VALUES (?,?,?,?,?,?,?,?)"
+)
+UPSERT_STATS_SQL = (
+    "INSERT INTO stats(ticker,last_trade_ts_ms) VALUES(?,?) "
+    "ON CONFLICT(ticker) DO UPDATE SET last_trade_ts_ms=MAX(last_trade_ts_ms, excluded.last_trade_ts_ms)"
+)
+SELECT_LAST_TRADE_TS_SQL = "SELECT last_trade_ts_ms FROM stats WHERE ticker=?"
 
 async def last_trade_ts_for_ticker(db, ticker: str) -> int:
-    cur = await db.execute("SELECT last_trade_ts_ms FROM stats WHERE ticker=?", (ticker,))
+    cur = await db.execute(SELECT_LAST_TRADE_TS_SQL, (ticker,))
     row = await cur.fetchone()
     await cur.close()
     return int(row[0]) if row else 0
 
-async def update_last_trade_ts(db, ticker: str, ts_ms: int):
-    await db.execute(
-        "INSERT INTO stats(ticker,last_trade_ts_ms) VALUES(?,?) "
-        "ON CONFLICT(ticker) DO UPDATE SET last_trade_ts_ms=excluded.last_trade_ts_ms",
-        (ticker, ts_ms)
+async def update_last_trade_ts_many(db, last_ts: Dict[str, int]):
+    await db.executemany(UPSERT_STATS_SQL, list(last_ts.items()))
+
+async def store_prints(db, rows: List[Tuple[str, int, str, str, int, int, float, str]]):
+    await db.executemany(INSERT_PRINT_SQL, rows)
+
+ACCUM_WINDOW_MS = 10*60*1000
+
+_RECENT_BIG: Deque[Tuple[int, str, str]] = deque()
+_BIG_BY_TICKER: Counter = Counter()
+_BIG_IDS: set = set()
+_big_cutoff = 0
+
+def _big_evict(cutoff: int):
+    global _big_cutoff
+    if cutoff > _big_cutoff:
+        _big_cutoff = cutoff
+    while _RECENT_BIG and _RECENT_BIG[0][0] < _big_cutoff:
+        _, tk, tid = _RECENT_BIG.popleft()
+        _BIG_IDS.discard(tid)
+        _BIG_BY_TICKER[tk] -= 1
+        if _BIG_BY_TICKER[tk] <= 0:
+            del _BIG_BY_TICKER[tk]
+
+def big_print_push(trade_id: str, ticker: str, ts_ms: int):
+    if trade_id in _BIG_IDS or ts_ms < _big_cutoff:
+        return
+    _RECENT_BIG.append((ts_ms, ticker, trade_id))
+    _BIG_BY_TICKER[ticker] += 1
+    _BIG_IDS.add(trade_id)
+    _big_evict(ts_ms - ACCUM_WINDOW_MS)
+
+def big_prints_10m(ticker: str, ts_ms: int) -> int:
+    _big_evict(ts_ms - ACCUM_WINDOW_MS)
+    return _BIG_BY_TICKER[ticker]
+
+async def big_prints_warm(db):
+    cur = await db.execute(
+        "SELECT trade_id, ticker, ts_ms FROM prints WHERE ts_ms>=? AND notional_usd>=? ORDER BY ts_ms",
+        (now_ms() - ACCUM_WINDOW_MS, DEFAULT_THRESH)
     )
-    await db.commit()
-
-async def store_print(db, trade_id: str, ts_ms: int, ticker: str, side: str, count: int, yes_cents: int, notional_usd: float, flags: List[str]):
-    try:
-        await db.execute(
-            "INSERT INTO prints(trade_id, ts_ms, ticker, side, count, yes_cents, notional_usd, flags) VALUES (?,?,?,?,?,?,?,?)",
-            (trade_id, ts_ms, ticker, side, count, yes_cents, notional_usd, ",".join(flags))
-        )
-        await db.commit()
-    except aiosqlite.IntegrityError:
-        pass
+    rows = await cur.fetchall()
+    await cur.close()
+    for trade_id, ticker, ts_ms in rows:
+        big_print_push(trade_id, ticker, int(ts_ms))
 
 async def load_subscribers(db) -> List[Tuple[int, int, float, str, str]]:
     cur = await db.execute("SELECT user_id, alerts_on, thresh_usd, topic, tz FROM subs")
@@ -355,6 +587,48 @@ async def notify_user(uid: int, text: str, kb=None):
     except TelegramNetworkError as e:
         log.warning("Notify %s failed: %s", uid, e)
 
+NOTIFY_SEM = asyncio.Semaphore(25)
+NOTIFY_RATE = 25  # msgs/s, under Telegram's ~30 msg/s global limit
+NOTIFY_RETRIES = 3
+
+_notify_rate_lock = asyncio.Lock()
+_notify_next = 0.0
+
+async def _notify_slot():
+    global _notify_next
+    async with _notify_rate_lock:
+        now = asyncio.get_running_loop().time()
+        if _notify_next > now:
+            await asyncio.sleep(_notify_next - now)
+            now = _notify_next
+        _notify_next = now + 1.0 / NOTIFY_RATE
+
+async def _send(uid: int, text: str, kb=None):
+    for attempt in range(NOTIFY_RETRIES):
+        await _notify_slot()
+        try:
+            async with NOTIFY_SEM:
+                return await notify_user(uid, text, kb)
+        except TelegramRetryAfter as e:
+            if attempt == NOTIFY_RETRIES - 1:
+                raise
+            log.warning("Telegram rate limit for %s; retrying in %ss", uid, e.retry_after)
+            await asyncio.sleep(e.retry_after)
+
+async def _send_in_order(uid: int, msgs: List[Tuple[str, Optional[InlineKeyboardMarkup]]]):
+    for text, kb in msgs:
+        try:
+            await _send(uid, text, kb)
+        except Exception as e:
+            log.warning("Notify %s failed: %s", uid, e)
+
+async def notify_many(outbox: List[Tuple[int, str, Optional[InlineKeyboardMarkup]]]):
+    # One task per user keeps each user's alerts in chronological order.
+    per_user: Dict[int, List[Tuple[str, Optional[InlineKeyboardMarkup]]]] = {}
+    for uid, text, kb in outbox:
+        per_user.setdefault(uid, []).append((text, kb))
+    await asyncio.gather(*(_send_in_order(uid, msgs) for uid, msgs in per_user.items()))
+
 def clean_title(t: Optional[str], fallback: str) -> str:
     if t and t.strip():
         return t.strip()
@@ -376,11 +650,11 @@ def fmt_alert_text(title: str, ticker: str, side: str, notional: float, count: i
     )
 
 async def ingest_loop():
-    await db_init()
-    async with aiosqlite.connect(DB_PATH) as db:
-        v = await db_get(db, "last_ts_ms", "")
-        last_ts = int(v) if v.isdigit() else (now_ms() - 10*60*1000)
-        log.info("Starting ingest from %s", last_ts)
+    db, rdb = DB, RDB
+    v = await db_get(db, "last_ts_ms", "")
+    last_ts = int(v) if v.isdigit() else (now_ms() - 10*60*1000)
+    log.info("Starting ingest from %s", last_ts)
+    await big_prints_warm(db)
 
     while True:
         try:
@@ -390,65 +664,96 @@ async def ingest_loop():
             await asyncio.sleep(POLL_INTERVAL)
             continue
 
-        if not trades:
+        batch = parse_trades(trades)
+        if not batch:
             await asyncio.sleep(POLL_INTERVAL)
             continue
 
+        subs = await load_subscribers(rdb)
+        groups = group_subs_by_topic([(uid, thr, top, tz) for (uid, on, thr, top, tz) in subs if on == 1])
+        alert_tickers = list({b[2] for b in batch if alert_targets(groups, b[2], b[6])})
+        results = await asyncio.gather(*(get_market_title(tk) for tk in alert_tickers), return_exceptions=True)
+        titles = {tk: res for tk, res in zip(alert_tickers, results) if isinstance(res, str)}
+
         max_seen = last_ts
-        async with aiosqlite.connect(DB_PATH) as db:
-            subs = await load_subscribers(db)
-            active_subs = [(uid, thr, top, tz) for (uid, on, thr, top, tz) in subs if on == 1]
-
-            for tr in trades:
-                trade_id, ts_ms, ticker, side, count, yes_cents = trade_core_fields(tr)
-                notional = trade_notional_usd(tr)
-                if notional <= 0:
-                    continue
+        async with DB_LOCK:
+            await db.execute("BEGIN")
+            try:
+                pending_prints: List[Tuple[str, int, str, str, int, int, float, str]] = []
+                outbox: List[Tuple[int, str, InlineKeyboardMarkup]] = []
+                buttons: Dict[str, InlineKeyboardMarkup] = {}
+                batch_last_ts: Dict[str, int] = {}
+
+                for trade_id, ts_ms, ticker, side, count, yes_cents, notional in batch:
+                    flags: List[str] = []
+
+                    last_tick_ts = batch_last_ts.get(ticker) or await last_trade_ts_for_ticker(db, ticker)
+                    if last_tick_ts and (ts_ms - last_tick_ts) >= 2*3600*1000:
+                        flags.append("Silent-breaker")
+                    batch_last_ts[ticker] = max(ts_ms, batch_last_ts.get(ticker, 0))
+
+                    med = await ticker_median_count_24h(rdb, ticker)
+                    if med > 0 and count >= 5*med:
+                        flags.append("Unusual size")
+
+                    pending_prints.append((trade_id, ts_ms, ticker, side, count, yes_cents, notional, ",".join(flags)))
+                    if notional >= DEFAULT_THRESH:
+                        big_print_push(trade_id, ticker, ts_ms)
+
+                    if big_prints_10m(ticker, ts_ms) >= 3:
+                        flags.append("Accumulation")
+
+                    targets = alert_targets(groups, ticker, notional)
+                    if targets:
+                        title = clean_title(titles.get(ticker), ticker)
+                        texts: Dict[str, str] = {}
+                        for uid, tz in targets:
+                            text = texts.get(tz)
+                            if text is None:
+                                text = texts[tz] = fmt_alert_text(title, ticker, side, notional, count, yes_cents, ts_ms, flags, tz)
+                            kb = buttons.get(ticker)
+                            if kb is None:
+                                kb = buttons[ticker] = kalshi_btn_for(ticker)
+                            outbox.append((uid, text, kb))
+
+                    if ts_ms > max_seen:
+                        max_seen = ts_ms
+
+                await store_prints(db, pending_prints)
+                await update_last_trade_ts_many(db, batch_last_ts)
+                if max_seen > last_ts:
+                    await db_set(db, "last_ts_ms", str(max_seen))
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+        last_ts = max_seen
 
-                flags: List[str] = []
-
-                last_tick_ts = await last_trade_ts_for_ticker(db, ticker)
-                if last_tick_ts and (ts_ms - last_tick_ts) >= 2*3600*1000:
-                    flags.append("Silent-breaker")
-                await update_last_trade_ts(db, ticker, ts_ms)
-
-                counts24 = await ticker_recent_counts_24h(db, ticker)
-                med = median(counts24)
-                if med > 0 and count >= 5*med:
-                    flags.append("Unusual size")
-
-                await store_print(db, trade_id, ts_ms, ticker, side, count, yes_cents, notional, flags)
-
-                since10 = ts_ms - 10*60*1000
-                cur = await db.execute(
-                    "SELECT COUNT(*) FROM prints WHERE ticker=? AND ts_ms>=? AND notional_usd>=?",
-                    (ticker, since10, DEFAULT_THRESH)
-                )
-                n10 = (await cur.fetchone())[0]
-                await cur.close()
-                if n10 >= 3:
-                    flags.append("Accumulation")
-
-                for uid, thr, top, tz in active_subs:
-                    if notional >= thr and topic_match(top, ticker):
-                        title = await get_market_title(ticker)
-                        title = clean_title(title, ticker)
-                        await notify_user(
-                            uid,
-                            fmt_alert_text(title, ticker, side, notional, count, yes_cents, ts_ms, flags, tz),
-                            kb=kalshi_btn_for(ticker),
-                        )
-
-                if ts_ms > max_seen:
-                    max_seen = ts_ms
-
-        if max_seen > last_ts:
-            last_ts = max_seen
-            async with aiosqlite.connect(DB_PATH) as db2:
-                await db_set(db2, "last_ts_ms", str(last_ts))
+        if outbox:
+            await notify_many(outbox)
 
         await asyncio.sleep(POLL_INTERVAL)
 
+async def prune_prints(db):
+    async with DB_LOCK:
+        cur = await db.execute("DELETE FROM prints WHERE ts_ms < ?", (now_ms() - PRINTS_RETENTION_MS,))
+        deleted = cur.rowcount
+        await cur.close()
+        await db.commit()
+        cur = await db.execute("PRAGMA incremental_vacuum(1000)")
+        await cur.fetchall()
+        await cur.close()
+    if deleted:
+        log.info("Pruned %s prints older than %s days", deleted, PRINTS_RETENTION_MS // (24*3600*1000))
+
+async def prune_loop():
+    while True:
+        try:
+            await prune_prints(DB)
+        except Exception as e:
+            log.error("Prune failed: %s", e)
+        await asyncio.sleep(PRUNE_INTERVAL)
+
 HELP_TEXT = (
     "<b>Valshi — Whale Alerts for Kalshi</b>\n"
     "Tracks large trades that may signal high conviction.\n\n"
@@ -472,24 +777,18 @@ async def btn_menu(m: Message):
 
 @dp.message(F.text == "▶️ Alerts ON")
 async def btn_on(m: Message):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO subs(user_id, alerts_on, thresh_usd, topic, tz) VALUES(?,?,?,?,?) "
-            "ON CONFLICT(user_id) DO UPDATE SET alerts_on=1",
-            (m.from_user.id, 1, DEFAULT_THRESH, 'all', 'UTC')
-        )
-        await db.commit()
+    async with DB_LOCK:
+        await ensure_sub(DB, m.from_user.id)
+        await DB.execute("UPDATE subs SET alerts_on=? WHERE user_id=?", (1, m.from_user.id))
+        await DB.commit()
     await m.answer("✅ Alerts <b>ON</b>.", reply_markup=MAIN_KB)
 
 @dp.message(F.text == "⏹ Alerts OFF")
 async def btn_off(m: Message):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO subs(user_id, alerts_on, thresh_usd, topic, tz) VALUES(?,?,?,?,?) "
-            "ON CONFLICT(user_id) DO UPDATE SET alerts_on=0",
-            (m.from_user.id, 0, DEFAULT_THRESH, 'all', 'UTC')
-        )
-        await db.commit()
+    async with DB_LOCK:
+        await ensure_sub(DB, m.from_user.id)
+        await DB.execute("UPDATE subs SET alerts_on=? WHERE user_id=?", (0, m.from_user.id))
+        await DB.commit()
     await m.answer("🛑 Alerts <b>OFF</b>.", reply_markup=MAIN_KB)
 
 @dp.message(F.text == "💵 Set Threshold")
@@ -500,18 +799,15 @@ async def btn_thresh(m: Message):
 async def cmd_thresh(m: Message):
     await handle_thresh_input(m)
 
-@dp.message(lambda msg: msg.text and msg.text.strip().isdigit())
+@dp.message(F.text.regexp(r"^\s*\d+(\.\d+)?\s*$"))
 async def handle_thresh_input(m: Message):
     val = float(m.text.strip())
     if val < 500:
         return await m.answer("Min threshold is <b>$500</b> to avoid spam.", reply_markup=MAIN_KB)
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO subs(user_id, alerts_on, thresh_usd, topic, tz) VALUES(?,?,?,?,?) "
-            "ON CONFLICT(user_id) DO UPDATE SET thresh_usd=?",
-            (m.from_user.id, 1, val, 'all', 'UTC', val)
-        )
-        await db.commit()
+    async with DB_LOCK:
+        await ensure_sub(DB, m.from_user.id)
+        await DB.execute("UPDATE subs SET thresh_usd=? WHERE user_id=?", (val, m.from_user.id))
+        await DB.commit()
     await m.answer(f"✅ Threshold set to <b>${val:,.0f}</b>.", reply_markup=MAIN_KB)
 
 @dp.message(F.text == "🧭 Set Topic")
@@ -525,20 +821,17 @@ async def cmd_topic(m: Message):
         return await m.answer("Usage: <code>/topic macro|crypto|sports|all</code>", reply_markup=MAIN_KB)
     await set_topic_value(m, parts[1].strip())
 
-@dp.message(lambda msg: msg.text and msg.text.lower() in ("macro","crypto","sports","all"))
+@dp.message(F.text.lower().in_({"macro", "crypto", "sports", "all"}))
 async def handle_topic_word(m: Message):
     await set_topic_value(m, m.text.strip().lower())
 
 async def set_topic_value(m: Message, t: str):
     if t not in ("macro", "crypto", "sports", "all"):
         return await m.answer("Pick one of: <code>macro</code>, <code>crypto</code>, <code>sports</code>, <code>all</code>", reply_markup=MAIN_KB)
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO subs(user_id, alerts_on, thresh_usd, topic, tz) VALUES(?,?,?,?,?) "
-            "ON CONFLICT(user_id) DO UPDATE SET topic=?",
-            (m.from_user.id, 1, DEFAULT_THRESH, t, 'UTC', t)
-        )
-        await db.commit()
+    async with DB_LOCK:
+        await ensure_sub(DB, m.from_user.id)
+        await DB.execute("UPDATE subs SET topic=? WHERE user_id=?", (t, m.from_user.id))
+        await DB.commit()
     await m.answer(f"✅ Topic filter: <b>{_html.escape(t)}</b>", reply_markup=MAIN_KB)
 
 @dp.message(F.text == "🌍 Set Timezone")
@@ -555,7 +848,7 @@ async def cmd_tz(m: Message):
         return await set_timezone_value(m, parts[2].strip())
     return await m.answer("Usage: <code>/tz</code> or <code>/tz set Region/City</code>", reply_markup=MAIN_KB)
 
-@dp.message(lambda msg: msg.text and "/" in msg.text and msg.text.count("/") == 1 and msg.text[0].isalpha())
+@dp.message(F.text.regexp(r"^[A-Za-z][A-Za-z0-9_+\-]*/[A-Za-z0-9_+\-]+\s*$"))
 async def handle_tz_text(m: Message):
     await set_timezone_value(m, m.text.strip())
 
@@ -564,13 +857,10 @@ async def set_timezone_value(m: Message, tz_arg: str):
         _ = ZoneInfo(tz_arg)
     except Exception:
         return await m.answer("Invalid timezone. Use IANA names like <code>Europe/London</code> or <code>America/New_York</code>.", reply_markup=MAIN_KB)
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO subs(user_id, alerts_on, thresh_usd, topic, tz) VALUES(?,?,?,?,?) "
-            "ON CONFLICT(user_id) DO UPDATE SET tz=?",
-            (m.from_user.id, 0, DEFAULT_THRESH, 'all', tz_arg, tz_arg)
-        )
-        await db.commit()
+    async with DB_LOCK:
+        await ensure_sub(DB, m.from_user.id)
+        await DB.execute("UPDATE subs SET tz=? WHERE user_id=?", (tz_arg, m.from_user.id))
+        await DB.commit()
     await m.answer(f"✅ Timezone set to <b>{_html.escape(tz_arg)}</b>.", reply_markup=MAIN_KB)
 
 def list_keyboard(tickers: List[str]) -> Optional[InlineKeyboardMarkup]:
@@ -598,14 +888,13 @@ async def cmd_top(m: Message):
 
 async def show_recent(m: Message):
     _, thr, _, tz = await get_user_prefs(m.from_user.id)
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT ts_ms,ticker,side,notional_usd,count,yes_cents,flags "
-            "FROM prints WHERE notional_usd>=? ORDER BY ts_ms DESC LIMIT 10",
-            (thr,)
-        )
-        rows = await cur.fetchall()
-        await cur.close()
+    cur = await RDB.execute(
+        "SELECT ts_ms,ticker,side,notional_usd,count,yes_cents,flags "
+        "FROM prints WHERE notional_usd>=? ORDER BY ts_ms DESC LIMIT 10",
+        (thr,)
+    )
+    rows = await cur.fetchall()
+    await cur.close()
     if not rows:
         return await m.answer("No whale prints (≥ your threshold) yet.", reply_markup=MAIN_KB)
 
@@ -629,12 +918,30 @@ async def show_recent(m: Message):
 async def show_top(m: Message):
     _, _, _, tz = await get_user_prefs(m.from_user.id)
     nowm = now_ms()
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT ticker, side, MAX(notional_usd), MAX(ts_ms) "
+    since = nowm - 24*3600*1000
+    cur = await RDB.execute(
+        "SELECT ticker, side, notional_usd, ts_ms "
+        "FROM prints WHERE ts_ms>=? ORDER BY notional_usd DESC LIMIT 200",
+        (since,)
+    )
+    top = await cur.fetchall()
+    await cur.close()
+    seen = set()
+    rows = []
+    for tk, side, notional, ts_ms in top:
+        if (tk, side) in seen:
+            continue
+        seen.add((tk, side))
+        rows.append((tk, side, notional, ts_ms))
+        if len(rows) == 10:
+            break
+    if len(rows) < 10 and len(top) == 200:
+        # A few hot markets filled the page; fall back to the exact grouped query.
+        cur = await RDB.execute(
+            "SELECT ticker, side, MAX(notional_usd), ts_ms "
             "FROM prints WHERE ts_ms>=? GROUP BY ticker, side "
             "ORDER BY MAX(notional_usd) DESC LIMIT 10",
-            (nowm - 24*3600*1000,)
+            (since,)
         )
         rows = await cur.fetchall()
         await cur.close()
@@ -673,11 +980,13 @@ async def cmd_health(m: Message):
 async def main():
     await db_init()
     asyncio.create_task(ingest_loop())
+    asyncio.create_task(prune_loop())
     log.info("Valshi starting…")
     try:
         await dp.start_polling(bot)
     finally:
         await KALSHI.client.aclose()
+        await db_close()
         await bot.session.close()
         log.info("Shutdown complete.")
 